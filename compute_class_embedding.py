@@ -5,7 +5,8 @@ import scipy.linalg, scipy.spatial.distance
 import time
 import argparse
 import pickle
-from collections import OrderedDict
+import concurrent.futures
+from collections import OrderedDict, Counter
 
 from class_hierarchy import ClassHierarchy
 
@@ -27,15 +28,14 @@ def unitsphere_embedding(class_sim):
     if (class_sim.shape[0] == 0):
         raise ValueError('Empty class_sim given.')
     
-    # Place first class
-    nc = class_sim.shape[0]
-    embeddings = np.zeros((nc, nc))
-    embeddings[0,0] = 1.
-    
-    # Iteratively place all remaining classes
-    for c in range(1, nc):
-        embeddings[c, :c] = np.linalg.solve(embeddings[:c, :c], class_sim[c, :c])
-        embeddings[c, c] = np.sqrt(1. - np.sum(embeddings[c, :c] ** 2))
+    # Placing one class after another so that it has unit norm and the desired dot products with all previous ones
+    # results in the lower-triangular Cholesky factor of the similarity matrix, which is computed at once.
+    class_sim = class_sim.copy()
+    np.fill_diagonal(class_sim, 1.)
+    try:
+        embeddings = np.linalg.cholesky(class_sim)
+    except np.linalg.LinAlgError:
+        raise RuntimeError('Given class_sim is not positive definite.')
     
     return embeddings
 
@@ -72,7 +72,7 @@ def sim_approx(class_sim, num_dim = None):
 
 
 
-def euclidean_embedding(class_dist, solver = 'general'):
+def euclidean_embedding(class_dist, solver = 'cholesky', dtype = np.float64):
     """
     Finds an embedding of `n` classes in an `(n-1)`-dimensional space, so that their Euclidean distances correspond
     to pre-defined ones.
@@ -80,9 +80,12 @@ def euclidean_embedding(class_dist, solver = 'general'):
     class_dist - `n-by-n` matrix specifying the desired distance between each pair of classes.
                  The distances in this matrix *must* define a proper metric that fulfills the triangle inequality.
                  Otherwise, a `RuntimeError` will be raised.
-    solver - The linear solver to be used. May be either 'general' or 'triangular'. The triangular solver is faster,
-             since we are dealing with an equation system in triangular form here, but less accurate than the
-             general solver.
+    solver - The linear solver to be used. May be 'cholesky', 'general', or 'triangular'. The Cholesky solver places
+             all classes at once by factorizing their Gram matrix and is by far the fastest. The other two place one
+             class after another. The triangular solver is faster than the general one, since we are dealing with an
+             equation system in triangular form here, but less accurate.
+    dtype - The data type used for computing the embeddings. Using `np.float32` halves the memory required for the
+            result and all intermediate buffers, at the cost of precision.
     
     Returns: `n-by-(n-1)` matrix with rows being the locations of the corresponding classes in the embedding space.
     """
@@ -92,14 +95,52 @@ def euclidean_embedding(class_dist, solver = 'general'):
         raise ValueError('Given class_dist has invalid shape. Expected: (n, n). Got: {}'.format(class_dist.shape))
     if (class_dist.shape[0] == 0):
         raise ValueError('Empty class_dist given.')
+    if not np.all(np.isfinite(class_dist)):
+        raise ValueError('Given class_dist contains non-finite values.')
+    if solver not in ('cholesky', 'general', 'triangular'):
+        raise ValueError('Unknown solver: {}'.format(solver))
     
-    # Place first class at the origin
+    # Place first class at the origin.
+    # Since embeddings are lower-triangular, we allocate them uninitialized and only clear the remaining coordinates
+    # of each row after placing the class to avoid writing the entire matrix twice.
     nc = class_dist.shape[0]
-    embeddings = np.zeros((nc, nc - 1))
+    embeddings = np.empty((nc, nc - 1), dtype = dtype)
+    embeddings[0] = 0
+    
+    # With the first class at the origin, the locations of all other classes are given by the lower-triangular
+    # Cholesky factor of their Gram matrix <x_i, x_j> = (d_0i^2 + d_0j^2 - d_ij^2) / 2.
+    # We build the Gram matrix directly in the embedding matrix and factorize it in place. Since it is symmetric,
+    # the upper factor of its Fortran-ordered transpose is the lower factor in C order.
+    if solver == 'cholesky':
+        sq_dist0 = class_dist[0, 1:].astype(dtype) ** 2
+        gram = embeddings[1:]
+        np.square(class_dist[1:, 1:], out = gram)
+        np.subtract(sq_dist0[:, None], gram, out = gram)
+        gram += sq_dist0[None, :]
+        gram /= 2
+        potrf, = scipy.linalg.get_lapack_funcs(('potrf',), (gram.T,))
+        factor, info = potrf(gram.T, lower = 0, overwrite_a = 1, clean = 1)
+        if info < 0:
+            raise ValueError('Illegal value in argument {} of LAPACK potrf.'.format(-info))
+        elif (info > 0) and (info < nc - 1):
+            # The class corresponding to the failing leading minor lies outside all hyperspheres or within
+            # the subspace spanned by the previous classes, so that no further class could be placed.
+            raise RuntimeError('Failed to place class #{}: Hyperspheres do not intersect in a new dimension.'.format(info + 1))
+        elif info > 0:
+            # The last class may lie exactly on the intersection of the hyperspheres without requiring an
+            # additional dimension, which only the iterative solvers can handle.
+            return euclidean_embedding(class_dist, 'general', dtype)
+        if not np.shares_memory(factor, embeddings):
+            gram[:] = factor.T
+        return embeddings
     
     # Place second class offset along the first axis by the desired distance 
+    # and keep track of the squared norms of all placed classes
+    sq_norms = np.zeros(nc, dtype = dtype)
     if nc > 1:
         embeddings[1,0] = class_dist[0,1]
+        embeddings[1,1:] = 0
+        sq_norms[1] = embeddings[1,0] ** 2
     
     # Iteratively place all remaining classes.
     # Each new class must be located at an intersection of all hyperspheres centered at the already existing classes
@@ -107,19 +148,33 @@ def euclidean_embedding(class_dist, solver = 'general'):
     for c in range(2, nc):
 
         centers = embeddings[1:c, :c-1]
-        radii = class_dist[:c, c] ** 2
+        radii = class_dist[c, :c].astype(dtype) ** 2  # squared radii
 
-        # Compute first c-1 coordinates of the new center
-        b = (radii[0] - radii[1:] + np.sum(centers ** 2, axis = 1)) / 2
+        # Compute first c-1 coordinates of the new center.
+        # Its row in the embedding matrix serves as buffer for the right-hand side of the equation system, which
+        # is overwritten with the solution. Since all inputs are finite, we skip the finiteness checks of scipy.
+        b = embeddings[c, :c-1]
+        np.subtract(radii[0], radii[1:], out = b)
+        b += sq_norms[1:c]
+        b /= 2
         solve_err = False
         try:
             if solver == 'general':
-                x = np.linalg.solve(centers, b)
-            elif solver == 'triangular':
-                x = scipy.linalg.solve_triangular(centers, b, lower = True)
+                # Existing rows of the equation system do not change when adding a new class, so we update
+                # its QR decomposition by one row instead of solving the entire system from scratch.
+                if c == 2:
+                    Q, R = scipy.linalg.qr(centers)
+                else:
+                    Q, R = scipy.linalg.qr_insert(Q, np.hstack((R, np.zeros((c - 2, 1), dtype = R.dtype))), centers[-1], c - 2, which = 'row',
+                                                  overwrite_qru = True, check_finite = False)
+                x = scipy.linalg.solve_triangular(R, np.dot(Q.T, b), overwrite_b = True, check_finite = False)
+                diag = np.abs(R.diagonal())
             else:
-                raise ValueError('Unknown solver: {}'.format(solver))
-            if not np.allclose(np.dot(centers, x), b):
+                x = scipy.linalg.solve_triangular(centers, b, lower = True, overwrite_b = True, check_finite = False)
+                diag = np.abs(centers.diagonal())
+            # Instead of checking the residual of the solution, which would require another matrix-vector product,
+            # consider the system to be singular if the diagonal of its triangular factor indicates a rank deficiency.
+            if diag.min() <= diag.max() * (c - 1) * np.finfo(dtype).eps:
                 solve_err = True
         except (np.linalg.LinAlgError, scipy.linalg.LinAlgError):
             solve_err = True
@@ -128,7 +183,7 @@ def euclidean_embedding(class_dist, solver = 'general'):
             raise RuntimeError('Failed to place class #{}: Hyperspheres do not intersect.'.format(c + 1))
 
         # Compute c-th coordindate of the new center
-        d_sq = np.sum(x ** 2)
+        d_sq = np.dot(x, x)
         if d_sq > radii[0]:
             raise RuntimeError('Failed to place class #{}: There is no common intersection of all spheres (offset: {}).'.format(
                                c + 1, np.sqrt(d_sq) - np.sqrt(radii[0])))
@@ -136,6 +191,8 @@ def euclidean_embedding(class_dist, solver = 'general'):
 
         embeddings[c, :c-1] = x
         embeddings[c, c-1] = z
+        embeddings[c, c:] = 0
+        sq_norms[c] = d_sq + z ** 2
     
     return embeddings
 
@@ -155,8 +212,10 @@ def mds(class_dist, num_dim = None):
     Returns: `n-by-d` matrix with rows being the locations of the corresponding classes in the embedding space.
     """
 
-    H = np.eye(class_dist.shape[0], dtype=class_dist.dtype) - np.ones(class_dist.shape, dtype=class_dist.dtype) / class_dist.shape[0]
-    B = np.dot(H, np.dot(class_dist ** 2, H)) / -2
+    # Double centering of squared distances. Applying the centering matrix H = I - 1/n from both sides amounts to
+    # subtracting row and column means, which avoids two dense matrix products.
+    sq_dist = class_dist ** 2
+    B = (sq_dist - sq_dist.mean(axis=0, keepdims=True) - sq_dist.mean(axis=1, keepdims=True) + sq_dist.mean()) / -2
 
     eigval, eigvec = np.linalg.eigh(B)
     nonzero_eigvals = (eigval > np.finfo(class_dist.dtype).eps)
@@ -173,6 +232,116 @@ def mds(class_dist, num_dim = None):
 
 
 
+def lcs_height_matrix(hierarchy, labels, num_workers = 1):
+    """
+    Computes the height of the lowest common subsumer for all pairs of given classes, divided by the height of the entire hierarchy.
+    This is equivalent to calling `hierarchy.lcs_height` for each pair of classes, but much faster for a large number of classes.
+    
+    hierarchy - The `ClassHierarchy` defining the relationships between the classes.
+    labels - List with the labels of `n` classes.
+    num_workers - Number of parallel processes to distribute the computation over.
+    
+    Returns: `n-by-n` matrix with dissimilarity scores in the range [0,1].
+    """
+    
+    if hierarchy.is_tree():
+        
+        # In a tree, the lowest common subsumer of two classes is the last node of the common prefix
+        # of their paths from the root, which we store as matrix of hypernym indices padded with -1
+        root_paths = []
+        for lbl in labels:
+            paths = hierarchy.root_paths(lbl)
+            root_paths.append(([lbl] + paths[0] if len(paths) > 0 else [lbl])[::-1])
+        hypernyms = list(set().union(*root_paths))
+        hypernym_ind = { hyp : i for i, hyp in enumerate(hypernyms) }
+        hypernym_data = np.full((len(labels), max(len(path) for path in root_paths)), -1, dtype = int)
+        for i, path in enumerate(root_paths):
+            hypernym_data[i, :len(path)] = [hypernym_ind[hyp] for hyp in path]
+        strip_func = _condensed_lcs_heights_tree
+    
+    else:
+        
+        # Collect all hypernyms shared by at least two of the given classes, sorted by decreasing depth,
+        # so that the first hypernym shared by two classes is their lowest common subsumer
+        class_hypernyms = [hierarchy.all_hypernym_depths(lbl) for lbl in labels]
+        hypernym_counts = Counter(hyp for hyps in class_hypernyms for hyp in hyps)
+        hypernyms = sorted((hyp for hyp, count in hypernym_counts.items() if count > 1), key = lambda hyp: hierarchy.depth(hyp), reverse = True)
+        hypernym_ind = { hyp : i for i, hyp in enumerate(hypernyms) }
+        
+        # Build binary matrix indicating the hypernyms of each class
+        hypernym_data = np.zeros((len(labels), len(hypernyms)), dtype = bool)
+        for i, hyps in enumerate(class_hypernyms):
+            hypernym_data[i, [hypernym_ind[hyp] for hyp in hyps if hyp in hypernym_ind]] = True
+        strip_func = _condensed_lcs_heights_dag
+    
+    hypernym_heights = np.array([hierarchy.heights[hyp] for hyp in hypernyms], dtype = float) / hierarchy.max_height
+    
+    # Fill the condensed upper triangle of the distance matrix, optionally distributing
+    # strips of rows with approximately the same number of class pairs over several processes
+    nc = len(labels)
+    if (num_workers > 1) and (nc > 2):
+        row_offsets = np.arange(nc - 1) * (2 * nc - np.arange(nc - 1) - 1) // 2
+        strip_bounds = np.unique(np.searchsorted(row_offsets, np.linspace(0, nc * (nc - 1) // 2, num_workers + 1)[:-1]))
+        strip_bounds = np.append(strip_bounds, nc - 1)
+        with concurrent.futures.ProcessPoolExecutor(num_workers, initializer = _init_lcs_worker, initargs = (strip_func, hypernym_data, hypernym_heights)) as executor:
+            class_dist = np.concatenate(list(executor.map(_lcs_worker, strip_bounds[:-1], strip_bounds[1:])))
+    else:
+        class_dist = strip_func(hypernym_data, hypernym_heights, 0, nc - 1)
+    class_dist = scipy.spatial.distance.squareform(class_dist)
+    
+    missing_lcs = np.argwhere(np.isnan(class_dist))
+    if len(missing_lcs) > 0:
+        raise RuntimeError('Classes {} and {} do not share any hypernyms.'.format(labels[missing_lcs[0,0]], labels[missing_lcs[0,1]]))
+    
+    return class_dist
+
+
+def _condensed_lcs_heights_tree(root_paths, hypernym_heights, start, stop):
+    """ Finds the lowest common subsumers of each class in the range `[start, stop)` and all subsequent ones in a tree, given a matrix of padded root paths, and returns their heights as part of a condensed distance matrix. """
+    
+    nc, max_depth = root_paths.shape
+    heights = np.empty((stop - start) * (2 * nc - start - stop - 1) // 2)
+    offset = 0
+    for i in range(start, stop):
+        mismatch = root_paths[i+1:] != root_paths[i]
+        lcs_depth = np.where(mismatch.any(axis = 1), mismatch.argmax(axis = 1), (root_paths[i] >= 0).sum())
+        heights[offset:offset+len(lcs_depth)] = np.where(lcs_depth > 0, hypernym_heights[root_paths[i, lcs_depth - 1]], np.nan)
+        offset += len(lcs_depth)
+    return heights
+
+
+def _condensed_lcs_heights_dag(is_hypernym, hypernym_heights, start, stop):
+    """ Finds the lowest common subsumers of each class in the range `[start, stop)` and all subsequent ones, given a binary class-hypernym matrix, and returns their heights as part of a condensed distance matrix. """
+    
+    nc = len(is_hypernym)
+    heights = np.empty((stop - start) * (2 * nc - start - stop - 1) // 2)
+    offset = 0
+    for i in range(start, stop):
+        common_hypernyms = is_hypernym[i+1:] & is_hypernym[i]
+        lcs_ind = common_hypernyms.argmax(axis = 1)
+        heights[offset:offset+len(lcs_ind)] = np.where(common_hypernyms[np.arange(len(lcs_ind)), lcs_ind], hypernym_heights[lcs_ind], np.nan)
+        offset += len(lcs_ind)
+    return heights
+
+
+_lcs_worker_data = None
+
+
+def _init_lcs_worker(strip_func, hypernym_data, hypernym_heights):
+    """ Stores the data shared by all tasks of a worker process of `lcs_height_matrix`. """
+    
+    global _lcs_worker_data
+    _lcs_worker_data = (strip_func, hypernym_data, hypernym_heights)
+
+
+def _lcs_worker(start, stop):
+    """ Computes a strip of the condensed distance matrix in a worker process of `lcs_height_matrix`. """
+    
+    strip_func, hypernym_data, hypernym_heights = _lcs_worker_data
+    return strip_func(hypernym_data, hypernym_heights, start, stop)
+
+
+
 if __name__ == '__main__':
     
     # Parse arguments
@@ -186,10 +355,11 @@ if __name__ == '__main__':
                         help = '''Which algorithm to use for computing class embeddings. Options are:
     - "unitsphere": Compute n-dimensional L2-normalized embeddings so that the dot products of class embeddings correspond to their semantic similarity.
     - "approx_sim": Compute embeddings of arbitrary dimensionality so that the dot products of class embeddings correspond to their semantic similarity.
-    - "spheres": Compute (n-1)-dimensional embeddings so that Euclidean distances of class embeddings correspond to their semantic dissimilarity using successive intersections of hyperspheres.
+    - "spheres": Compute (n-1)-dimensional embeddings so that Euclidean distances of class embeddings correspond to their semantic dissimilarity by placing each class at the intersection of hyperspheres around the previous ones, which is computed for all classes at once using a Cholesky decomposition.
     - "mds": Compute embeddings of arbitrary dimensionality so that Euclidean distances of class embeddings correspond to their semantic dissimilarity using classical multidimensional scaling.
 Default: "unitsphere"''')
     parser.add_argument('--num_dim', type = int, default = None, help = 'Number of embedding dimensions when using the "mds" or "approx_sim" method.')
+    parser.add_argument('--num_workers', type = int, default = 1, help = 'Number of parallel processes used for computing distances between classes.')
     parser.add_argument('--norm', action = 'store_true', default = False, help = 'Force L2-normalization of computed embeddings (most useful in combination with the approx_sim method).')
     args = parser.parse_args()
     id_type = str if args.str_ids else int
@@ -208,10 +378,7 @@ Default: "unitsphere"''')
     linear_labels = { lbl : i for i, lbl in enumerate(unique_labels) }
     
     # Compute target distances between classes
-    sem_class_dist = np.zeros((len(unique_labels), len(unique_labels)))
-    for i in range(len(unique_labels)):
-        for j in range(i + 1, len(unique_labels)):
-            sem_class_dist[i,j] = sem_class_dist[j,i] = hierarchy.lcs_height(unique_labels[i], unique_labels[j])
+    sem_class_dist = lcs_height_matrix(hierarchy, unique_labels, args.num_workers)
     
     # Compute class embeddings
     start_time = time.time()
@@ -229,14 +396,20 @@ Default: "unitsphere"''')
     print('Computed {}-dimensional semantic embeddings for {} classes using the "{}" method in {} seconds.'.format(
         embedding.shape[1], embedding.shape[0], args.method, stop_time - start_time)
     )
-    if args.method in ('unitsphere', 'approx_sim'):
-        sim_error = np.abs(np.dot(embedding, embedding.T) - (1. - sem_class_dist))
-        print('Maximum deviation from target similarities: {}'.format(sim_error.max()))
-        print('Average deviation from target similarities: {}'.format(sim_error.mean()))
-    else:
-        dist_error = np.abs(scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(embedding)) - sem_class_dist)
-        print('Maximum deviation from target distances: {}'.format(dist_error.max()))
-        print('Average deviation from target distances: {}'.format(dist_error.mean()))
+    
+    # Compare with target similarities or distances in chunks of rows to avoid several n-by-n matrices in memory
+    max_error, sum_error = 0., 0.
+    for start in range(0, len(embedding), 256):
+        chunk = slice(start, start + 256)
+        if args.method in ('unitsphere', 'approx_sim'):
+            error = np.abs(np.dot(embedding[chunk], embedding.T) - (1. - sem_class_dist[chunk]))
+        else:
+            error = np.abs(scipy.spatial.distance.cdist(embedding[chunk], embedding) - sem_class_dist[chunk])
+        max_error = max(max_error, error.max())
+        sum_error += error.sum()
+    target = 'similarities' if args.method in ('unitsphere', 'approx_sim') else 'distances'
+    print('Maximum deviation from target {}: {}'.format(target, max_error))
+    print('Average deviation from target {}: {}'.format(target, sum_error / sem_class_dist.size))
     
     if args.norm:
         embedding /= np.linalg.norm(embedding, axis=-1, keepdims=True)
@@ -247,4 +420,4 @@ Default: "unitsphere"''')
                 'ind2label' : unique_labels,
                 'label2ind' : linear_labels,
                 'embedding' : embedding
-        }, dump_file)
+        }, dump_file, protocol = 4)